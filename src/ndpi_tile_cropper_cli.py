@@ -15,11 +15,16 @@
 
 import argparse
 import glob
+import hashlib
+import io
 import json
 import logging
 import os
+import re
 import shutil
 import signal
+import struct
+import time
 
 import bioformats
 import bioformats.formatreader as format_reader
@@ -29,6 +34,7 @@ import numpy as np
 from zipfile import ZipFile
 from PIL import Image
 from bioformats import logback
+from slide_staging import SlideStagingCache
 
 
 class NDPITileCropperCLI(object):
@@ -89,7 +95,75 @@ class NDPITileCropperCLI(object):
         parser.add_argument(
             '--zip', '-z',
             action='store_true',
-            help='Zip the tiles output directory and remove the tiles directory. Unzip the tiles directory zip file, if it exists, before starting with the tiles creation.')
+            help='Write the tiles to a zip file instead of the tiles output directory. If the zip file exists, only the missing tiles are cropped and appended to it. A killed run is rolled back to its last checkpoint on the next run.')
+        resolution_group = parser.add_mutually_exclusive_group()
+        resolution_group.add_argument(
+            '--scale',
+            type=float,
+            default=None,
+            help='Downsampling factor relative to the full resolution image. E.g., 4 to crop 10x tiles from a 40x slide. '
+                 'Tiles are read from the closest pyramid level and resampled if needed.')
+        resolution_group.add_argument(
+            '--mpp',
+            type=float,
+            default=None,
+            help='Target resolution in microns per pixel. Tiles are read from the closest pyramid level and resampled '
+                 'if needed.')
+        parser.add_argument(
+            '--level',
+            type=int,
+            default=None,
+            help='Pyramid level to read the tiles from. 0 is the full resolution image. If not provided, the level is '
+                 'chosen using --scale or --mpp.')
+        parser.add_argument(
+            '--traversal', '-t',
+            default='row',
+            choices=['row', 'column', 'block', 'hilbert'],
+            help='Order in which the tiles are read. row: row by row, following the slide storage layout. column: column '
+                 'by column. block: native tile by native tile of the slide. hilbert: along a Hilbert curve.')
+        parser.add_argument(
+            '--align-to-native', '-a',
+            action='store_true',
+            help='Round the tile step down to a multiple of the native tile size of the slide, so that all the tiles '
+                 'start on native tile boundaries. The tile overlap grows accordingly. Ignored when the native tiles '
+                 'are larger than the tile step.')
+        parser.add_argument(
+            '--index-existing-tiles',
+            action='store_true',
+            help='Compute the statistics of the existing tiles that are missing from the tile index, e.g., tiles '
+                 'cropped by a version without the tile index. Every such tile is decoded, which can take long. '
+                 'Without this option, only the tiles written after the last tile index checkpoint of a killed run '
+                 'are indexed.')
+        parser.add_argument(
+            '--scratch-dir',
+            nargs='?', default=None, required=False,
+            help='Path to a local scratch directory. If provided, the input file is copied there and read from the local '
+                 'copy. E.g., /scratch/ndpi')
+        parser.add_argument(
+            '--scratch-size',
+            type=float,
+            default=100,
+            help='Maximum size of the staged copies in GB. The least recently used copies are removed to stay under '
+                 'this size. Other files in the scratch directory are not counted or removed.')
+        parser.add_argument(
+            '--plan', '-p',
+            action='store_true',
+            help='Only read the metadata and print a JSON plan with the number of tiles, the predicted output size and '
+                 'the predicted processing time. No tiles are read or written.')
+        parser.add_argument(
+            '--plan-output',
+            nargs='?', default=None, required=False,
+            help='Path to write the JSON plan to. If not provided, the plan is printed to the standard output.')
+        parser.add_argument(
+            '--cache-dir',
+            nargs='?', default=None, required=False,
+            help='Path to the directory where --plan caches the metadata of the input file. Defaults to '
+                 '$XDG_CACHE_HOME/ndpi-tile-cropper or ~/.cache/ndpi-tile-cropper.')
+        parser.add_argument(
+            '--calibration',
+            nargs='?', default=None, required=False,
+            help='Path to a calibration file used by --plan to predict the output size and processing time. This can be '
+                 'the metadata.json file of a previous run. E.g., data/NDPI/NDPI_1_tiles/NDPI_1/metadata.json')
         parser.add_argument(
             '--log-level', '-g',
             type=str,
@@ -108,10 +182,31 @@ class NDPITileCropperCLI(object):
 class NDPIFileCropper:
     """Crop tiles from an NDPISlide."""
 
+    # Files that are rewritten on every run. They are kept at the end of the zip file so that they can be replaced
+    # without duplicating the zip file entries.
+    ZIP_TRAILING_FILES = ['metadata.json', 'tile_index.npz']
+
+    # Number of tiles between two checkpoints. A checkpoint writes a tile index shard, and the zip file central
+    # directory in zip mode, so a hard killed run loses at most the tiles written since the last checkpoint.
+    CHECKPOINT_TILE_COUNT = 100
+
+    # Tile index shards written at the checkpoints. They are merged into the tile index file at exit.
+    # The tiles written since the last checkpoint are listed in the pending tiles file until their shard is written.
+    TILE_INDEX_PENDING_FILE = 'tile_index_pending.txt'
+    TILE_INDEX_SHARD_PATTERN = re.compile(r'^tile_index_(\d+)\.npz$')
+
+    # Pixels darker than this intensity are counted as tissue
+    TISSUE_INTENSITY_THRESHOLD = 220
+    # Tiles with a smaller tissue fraction are marked as empty
+    EMPTY_TISSUE_FRACTION = 0.01
+
     def __init__(self, input_file, output_dir=None, tile_size=1024, tile_overlap=0, tile_format='png', overwrite=False,
-                 zip_flag=False):
+                 zip_flag=False, scale=None, mpp=None, level=None, traversal='row', align_to_native=False,
+                 cache_dir=None, index_existing_tiles=False):
         """Initialize an NDPIFileCropper instance."""
         self.input_file_path = input_file
+        # Path to read the NDPISlide from. This can be a local copy of the input file.
+        self.read_file_path = input_file
         self.input_filename = os.path.basename(self.input_file_path)
         if output_dir is None:
             self.output_dir = os.path.dirname(self.input_file_path)
@@ -122,11 +217,32 @@ class NDPIFileCropper:
         self.tile_format = tile_format
         self.overwrite_flag = overwrite
         self.zip_flag = zip_flag
+        self.scale = scale
+        self.mpp = mpp
+        self.level = level
+        self.traversal = traversal
+        self.align_to_native = align_to_native
+        self.index_existing_tiles = index_existing_tiles
+        if cache_dir is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+            self.cache_dir = os.path.join(cache_home, 'ndpi-tile-cropper')
+        else:
+            self.cache_dir = cache_dir
         self.metadata = dict()
 
         self.total_tile_count = 0
         self.processed_tile_count = 0
 
+        # Metrics of the current run, used as calibration data for --plan, and of the previous runs
+        self.previous_metrics = None
+        self.crop_start_time = None
+        self.tile_planes_written = 0
+        self.bytes_written = 0
+
+        # Statistics of the tile z-planes written since the last checkpoint, and the number of the next shard
+        self.tile_index_rows = []
+        self.tile_index_shard_number = None
+
         # Handle SIGINT and SIGTERM
         signal.signal(signal.SIGINT, self.exit_program)
         signal.signal(signal.SIGTERM, self.exit_program)
@@ -134,7 +250,7 @@ class NDPIFileCropper:
     def read_metadata(self):
         """Read an NDPISlide."""
         logger.info(self.input_filename + ": Read NDPISlide metadata")
-        ome_xml = bioformats.get_omexml_metadata(self.input_file_path)
+        ome_xml = bioformats.get_omexml_metadata(self.read_file_path)
         b = bioformats.OMEXML(xml=ome_xml)
 
         calibration = b.image().Pixels.PhysicalSizeX
@@ -148,17 +264,134 @@ class NDPIFileCropper:
         self.metadata['width'] = width
         self.metadata['height'] = height
         self.metadata['z_plane'] = z_plane
+        self.metadata['levels'] = self.__get_pyramid_levels(b, width, height, z_plane)
+        self.__read_optimal_tile_sizes(self.metadata['levels'])
+
+    def _get_metadata_cache_path(self):
+        """Get the path of the metadata cache file of the NDPISlide. NDPISlides with the same name in different
+        directories have different cache files."""
+        input_file_hash = hashlib.sha1(os.path.abspath(self.input_file_path).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, input_file_hash + '_' + self.input_filename + '.json')
+
+    def load_cached_metadata(self):
+        """Load the NDPISlide metadata from the cache file. Returns False if the cache is missing or outdated."""
+        cache_file_path = self._get_metadata_cache_path()
+        if not os.path.exists(cache_file_path):
+            return False
+        with open(cache_file_path, 'r') as f:
+            cache = json.load(f)
+        file_stat = os.stat(self.input_file_path)
+        if cache.get('input_file_size') != file_stat.st_size or cache.get('input_file_mtime') != file_stat.st_mtime:
+            logger.info(self.input_filename + ": Metadata cache is outdated.")
+            return False
+        logger.info(self.input_filename + ": Read NDPISlide metadata from cache " + cache_file_path)
+        self.metadata = cache['metadata']
+        return True
+
+    def save_cached_metadata(self):
+        """Save the NDPISlide metadata to the cache file."""
+        cache_file_path = self._get_metadata_cache_path()
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        file_stat = os.stat(self.input_file_path)
+        cache = dict()
+        cache['input_file_size'] = file_stat.st_size
+        cache['input_file_mtime'] = file_stat.st_mtime
+        cache['metadata'] = self.metadata
+        with open(cache_file_path, 'w') as f:
+            json.dump(cache, f, indent=4)
+
+    @staticmethod
+    def __get_pyramid_levels(ome_metadata, width, height, z_plane):
+        """Get the pyramid levels (Bio-Formats series) of an NDPISlide, from full to lowest resolution."""
+        levels = []
+        for series in range(ome_metadata.image_count):
+            pixels = ome_metadata.image(series).Pixels
+            downsample = width / pixels.SizeX
+            # Pyramid levels keep the aspect ratio and the z-planes of the full resolution image. The macro and map
+            # images do not.
+            if pixels.SizeZ != z_plane or abs(pixels.SizeY - height / downsample) > 1:
+                continue
+            if len(levels) > 0 and downsample <= levels[-1]['downsample']:
+                continue
+            levels.append({'series': series, 'width': pixels.SizeX, 'height': pixels.SizeY,
+                           'downsample': round(downsample, 4)})
+        return levels
+
+    def __read_optimal_tile_sizes(self, levels):
+        """Read the optimal (native) tile width and height of each pyramid level from the reader."""
+        ImageReader = format_reader.make_image_reader_class()
+        reader = ImageReader()
+        try:
+            reader.setId(self.read_file_path)
+            for level in levels:
+                reader.setSeries(level['series'])
+                level['optimal_tile_width'] = javabridge.call(reader.o, 'getOptimalTileWidth', '()I')
+                level['optimal_tile_height'] = javabridge.call(reader.o, 'getOptimalTileHeight', '()I')
+        finally:
+            reader.close()
+
+    def _select_level(self):
+        """Select the pyramid level to read the tiles from and the scale of the output tiles."""
+        levels = self.metadata['levels']
+        if self.mpp is not None:
+            if not self.metadata['calibration']:
+                raise ValueError(self.input_filename + ": Calibration not found in metadata. Cannot use --mpp.")
+            scale = self.mpp / self.metadata['calibration']
+        elif self.scale is not None:
+            scale = self.scale
+        elif self.level is not None:
+            scale = levels[self.level]['downsample'] if 0 <= self.level < len(levels) else 1.0
+        else:
+            scale = 1.0
+
+        if scale < 1.0:
+            raise ValueError(self.input_filename + ": Scale must be at least 1.0. Upsampling is not supported.")
 
-    def __read_tile(self, x, y, z, width, height):
+        if self.level is not None:
+            if not 0 <= self.level < len(levels):
+                raise ValueError(self.input_filename + ": Level " + str(self.level) + " not found. Available levels: "
+                                 + str(len(levels)))
+            if levels[self.level]['downsample'] > scale * 1.001:
+                raise ValueError(self.input_filename + ": Level " + str(self.level) + " has a lower resolution than "
+                                 "the requested scale " + str(scale))
+            level_index = self.level
+        else:
+            # Use the lowest resolution level that still has at least the requested resolution
+            level_index = 0
+            for i in range(len(levels)):
+                if levels[i]['downsample'] <= scale * 1.001:
+                    level_index = i
+
+        level = dict(levels[level_index])
+        level['index'] = level_index
+        return scale, level
+
+    @staticmethod
+    def _resample_tile(img, width, height):
+        """Resample a tile read from a pyramid level to the requested tile size."""
+        if img.shape[0] == height and img.shape[1] == width:
+            return img
+        factor_y = img.shape[0] // height
+        factor_x = img.shape[1] // width
+        if factor_y > 0 and factor_x > 0 and img.shape[0] == height * factor_y and img.shape[1] == width * factor_x:
+            # Integer factors: average the pixel blocks in a single vectorized pass
+            blocks = img.reshape(height, factor_y, width, factor_x, img.shape[2])
+            return np.rint(blocks.mean(axis=(1, 3))).astype(img.dtype)
+        return np.asarray(Image.fromarray(img).resize((width, height), Image.BOX))
+
+    def __read_tile(self, x, y, z, width, height, series=0):
         """Read a tile from an NDPISlide."""
         logger.debug(self.input_filename + ": Read a tile from NDPISlide: " + str(x) + "x_" + str(y) + "y_" + str(z) + "z")
-        img_path = self.input_file_path
+        img_path = self.read_file_path
 
         ImageReader = format_reader.make_image_reader_class()
         reader = ImageReader()
         img = None
         try:
             reader.setId(img_path)
+            if series != 0:
+                reader.setSeries(series)
             img = reader.openBytesXYWH(z, x, y, width, height)
             img.shape = (height, width, 3)
         except Exception as ex:
@@ -173,9 +406,325 @@ class NDPIFileCropper:
         files = glob.glob(os.path.join(directory, "*." + file_extension))
         return len(files)
 
+    @staticmethod
+    def _align_step_to_native(step, native_size):
+        """Round a tile step down to a multiple of the native tile size, so that every tile starts on a native tile
+        boundary. A smaller step only increases the overlap, so the tiles still cover the image. The step is left as is
+        if the native tiles are larger than the tile step."""
+        if native_size <= 0 or native_size > step:
+            return step
+        aligned_step = np.floor(step / native_size) * native_size
+        return int(aligned_step) if aligned_step.is_integer() else float(aligned_step)
+
+    @staticmethod
+    def _hilbert_index(order, x, y):
+        """Get the position of a grid cell along a Hilbert curve filling a 2^order x 2^order grid."""
+        n = 1 << order
+        index = 0
+        s = n >> 1
+        while s > 0:
+            rx = 1 if x & s else 0
+            ry = 1 if y & s else 0
+            index += s * s * ((3 * rx) ^ ry)
+            # Rotate the quadrant
+            if ry == 0:
+                if rx == 1:
+                    x = n - 1 - x
+                    y = n - 1 - y
+                x, y = y, x
+            s >>= 1
+        return index
+
+    @staticmethod
+    def _get_native_tile_size(scale, level):
+        """Get the native tile size of a pyramid level, in output (scaled) coordinates."""
+        residual_scale = scale / level['downsample']
+        return (level.get('optimal_tile_width', 0) / residual_scale,
+                level.get('optimal_tile_height', 0) / residual_scale)
+
+    def _get_tile_step(self, scale, level):
+        """Get the distance between the start coordinates of neighbouring tiles, in output (scaled) coordinates."""
+        step_x = self._get_tile_size() - self._get_tile_overlap()
+        step_y = self._get_tile_size() - self._get_tile_overlap()
+        if self.align_to_native:
+            native_width, native_height = self._get_native_tile_size(scale, level)
+            step_x = self._align_step_to_native(step_x, native_width)
+            step_y = self._align_step_to_native(step_y, native_height)
+        return step_x, step_y
+
+    def _get_start_xy_list(self, scale, level):
+        """Get the start coordinates of the tiles, in output (scaled) coordinates, in traversal order."""
+        width = self._get_tile_size()
+        height = self._get_tile_size()
+        step_x, step_y = self._get_tile_step(scale, level)
+
+        output_width = int(self.metadata['width'] / scale)
+        output_height = int(self.metadata['height'] / scale)
+        start_x_list = np.arange(0, output_width - width, step_x).tolist()
+        start_y_list = np.arange(0, output_height - height, step_y).tolist()
+
+        native_width, native_height = self._get_native_tile_size(scale, level)
+
+        start_xy_list = []
+        if self.traversal == 'column':
+            for i in range(len(start_x_list)):
+                for j in range(len(start_y_list)):
+                    start_xy_list.append((start_x_list[i], start_y_list[j]))
+        elif self.traversal == 'hilbert':
+            order = max(int(np.ceil(np.log2(max(len(start_x_list), len(start_y_list), 1)))), 1)
+            grid_ij_list = [(i, j) for j in range(len(start_y_list)) for i in range(len(start_x_list))]
+            grid_ij_list.sort(key=lambda ij: self._hilbert_index(order, ij[0], ij[1]))
+            for i, j in grid_ij_list:
+                start_xy_list.append((start_x_list[i], start_y_list[j]))
+        else:
+            for j in range(len(start_y_list)):
+                for i in range(len(start_x_list)):
+                    start_xy_list.append((start_x_list[i], start_y_list[j]))
+            if self.traversal == 'block' and native_width > 0 and native_height > 0:
+                # Visit the native tiles row by row, and the tiles starting in each native tile row by row
+                start_xy_list.sort(key=lambda xy: (int(xy[1] // native_height), int(xy[0] // native_width),
+                                                   xy[1], xy[0]))
+
+        return start_xy_list
+
+    @staticmethod
+    def load_calibration(calibration_file_path):
+        """Load calibration data from a calibration file or from the metadata.json file of a previous run."""
+        with open(calibration_file_path, 'r') as f:
+            calibration = json.load(f)
+        if 'metrics' in calibration:
+            calibration = calibration['metrics']
+        return calibration
+
+    def plan(self, calibration=None):
+        """Estimate the number of tiles, the output size and the processing time using only the metadata."""
+        scale, level = self._select_level()
+        tile_count = len(self._get_start_xy_list(scale, level))
+        tile_plane_count = tile_count * self.metadata['z_plane']
+        output_pixel_count = tile_plane_count * self._get_tile_size() ** 2
+
+        # Uncompressed RGB size is always known. Other formats and the time need calibration data.
+        predicted_bytes = {'raw': output_pixel_count * 3}
+        predicted_seconds = None
+        if calibration is not None:
+            for tile_format, bytes_per_pixel in calibration.get('bytes_per_pixel', dict()).items():
+                predicted_bytes[tile_format] = int(round(output_pixel_count * bytes_per_pixel))
+            if calibration.get('seconds_per_megapixel') is not None:
+                predicted_seconds = round(output_pixel_count / 1e6 * calibration['seconds_per_megapixel'], 1)
+
+        plan = dict()
+        plan['input_file'] = self.input_file_path
+        plan['width'] = self.metadata['width']
+        plan['height'] = self.metadata['height']
+        plan['z_plane'] = self.metadata['z_plane']
+        plan['tile_size'] = self.tile_size
+        plan['tile_overlap'] = self.tile_overlap
+        plan['scale'] = scale
+        plan['level'] = level['index']
+        plan['tile_count'] = tile_count
+        plan['tile_plane_count'] = tile_plane_count
+        plan['predicted_bytes'] = predicted_bytes
+        plan['workers'] = 1
+        plan['predicted_wall_seconds'] = predicted_seconds
+        return plan
+
+    def _get_metrics(self):
+        """Get the metrics of the current run, combined with the metrics of the previous runs on the same tiles, so
+        that a short resumed run does not replace the calibration data of a full run."""
+        tile_planes_written = self.tile_planes_written
+        bytes_written = self.bytes_written
+        elapsed_seconds = time.time() - self.crop_start_time
+        output_pixel_count = self.tile_planes_written * self._get_tile_size() ** 2
+        if self.previous_metrics is not None and self.previous_metrics.get('tile_format') == self.tile_format:
+            tile_planes_written += self.previous_metrics['tile_planes_written']
+            bytes_written += self.previous_metrics['bytes_written']
+            elapsed_seconds += self.previous_metrics['elapsed_seconds']
+            output_pixel_count += self.previous_metrics.get(
+                'output_pixel_count', self.previous_metrics['tile_planes_written'] * self._get_tile_size() ** 2)
+
+        metrics = dict()
+        metrics['tile_format'] = self.tile_format
+        metrics['tile_planes_written'] = tile_planes_written
+        metrics['output_pixel_count'] = output_pixel_count
+        metrics['bytes_written'] = bytes_written
+        metrics['elapsed_seconds'] = round(elapsed_seconds, 3)
+        metrics['bytes_per_pixel'] = {self.tile_format: bytes_written / output_pixel_count}
+        metrics['seconds_per_megapixel'] = elapsed_seconds / (output_pixel_count / 1e6)
+        return metrics
+
+    @classmethod
+    def _compute_tile_statistics(cls, tile):
+        """Compute the statistics of a tile: mean and standard deviation per channel, tissue fraction, focus score
+        (variance of the Laplacian) and whether the tile is empty."""
+        pixels = tile.reshape(-1, tile.shape[2]).astype(np.float32)
+        mean = pixels.mean(axis=0)
+        std = pixels.std(axis=0)
+
+        gray = tile.astype(np.float32).mean(axis=2)
+        tissue_fraction = float(np.count_nonzero(gray < cls.TISSUE_INTENSITY_THRESHOLD)) / gray.size
+        laplacian = gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4 * gray[1:-1, 1:-1]
+        focus_score = float(laplacian.var())
+
+        return mean, std, tissue_fraction, focus_score, tissue_fraction < cls.EMPTY_TISSUE_FRACTION
+
+    @classmethod
+    def _get_tile_index_shard_paths(cls, crops_dir):
+        """Get the paths of the tile index shards of the crops directory, in the order they were written."""
+        shard_numbers = []
+        for file in os.listdir(crops_dir):
+            shard_match = cls.TILE_INDEX_SHARD_PATTERN.match(file)
+            if shard_match is not None:
+                shard_numbers.append(int(shard_match.group(1)))
+        return [os.path.join(crops_dir, 'tile_index_' + str(number) + '.npz') for number in sorted(shard_numbers)]
+
+    @classmethod
+    def _get_indexed_tile_planes(cls, crops_dir):
+        """Get the (x, y, z) coordinates of the tile z-planes in the tile index file and the tile index shards of the
+        crops directory."""
+        indexed_tile_planes = set()
+        tile_index_file_path = os.path.join(crops_dir, 'tile_index.npz')
+        tile_index_file_paths = [tile_index_file_path] if os.path.exists(tile_index_file_path) else []
+        for file_path in tile_index_file_paths + cls._get_tile_index_shard_paths(crops_dir):
+            with np.load(file_path) as tile_index:
+                indexed_tile_planes.update(zip(tile_index['x'].tolist(), tile_index['y'].tolist(),
+                                               tile_index['z'].tolist()))
+        return indexed_tile_planes
+
+    def _get_pending_tiles(self, crops_dir):
+        """Get the (x, y) coordinates of the tiles written after the last tile index checkpoint of a killed run."""
+        pending_file_path = os.path.join(crops_dir, self.TILE_INDEX_PENDING_FILE)
+        if not os.path.exists(pending_file_path):
+            return set()
+        with open(pending_file_path, 'r') as f:
+            return set(tuple(int(value) for value in line.split()) for line in f if line.strip())
+
+    def __add_pending_tile(self, crops_dir, start_x, start_y):
+        """List a tile in the pending tiles file before its z-planes are written."""
+        with open(os.path.join(crops_dir, self.TILE_INDEX_PENDING_FILE), 'a') as f:
+            f.write(str(start_x) + ' ' + str(start_y) + '\n')
+
+    def __remove_pending_tiles(self, crops_dir):
+        """Remove the pending tiles file once the statistics of its tiles are written."""
+        pending_file_path = os.path.join(crops_dir, self.TILE_INDEX_PENDING_FILE)
+        if os.path.exists(pending_file_path):
+            os.remove(pending_file_path)
+
+    def __index_existing_tile_plane(self, crops_dir, zip_file, zip_prefix, tile_name, start_x, start_y, z):
+        """Compute the statistics of a tile z-plane written by a previous run, read from the crops directory or the zip
+        file, if it exists."""
+        tile_path = zip_prefix + tile_name + '/' + str(z) + 'z.png'
+        if zip_file is not None:
+            if tile_path not in zip_file.NameToInfo:
+                return
+            with Image.open(io.BytesIO(zip_file.read(tile_path))) as im:
+                tile = np.array(im.convert('RGB'))
+            tile_offset = zip_file.getinfo(tile_path).header_offset
+        else:
+            tile_file_path = os.path.join(crops_dir, tile_path)
+            if not os.path.exists(tile_file_path):
+                return
+            with Image.open(tile_file_path) as im:
+                tile = np.array(im.convert('RGB'))
+            tile_offset = -1
+        mean, std, tissue_fraction, focus_score, empty = self._compute_tile_statistics(tile)
+        self.tile_index_rows.append((start_x, start_y, z, mean, std, tissue_fraction, focus_score, empty, tile_path,
+                                     tile_offset))
+
+    def _get_tile_index_rows_arrays(self):
+        """Get the statistics of the tile z-planes since the last checkpoint as tile index arrays."""
+        tile_index = dict()
+        tile_index['x'] = np.array([row[0] for row in self.tile_index_rows], dtype=np.int64)
+        tile_index['y'] = np.array([row[1] for row in self.tile_index_rows], dtype=np.int64)
+        tile_index['z'] = np.array([row[2] for row in self.tile_index_rows], dtype=np.int16)
+        tile_index['mean'] = np.array([row[3] for row in self.tile_index_rows], dtype=np.float32)
+        tile_index['std'] = np.array([row[4] for row in self.tile_index_rows], dtype=np.float32)
+        tile_index['tissue_fraction'] = np.array([row[5] for row in self.tile_index_rows], dtype=np.float32)
+        tile_index['focus_score'] = np.array([row[6] for row in self.tile_index_rows], dtype=np.float32)
+        tile_index['empty'] = np.array([row[7] for row in self.tile_index_rows], dtype=bool)
+        tile_index['path'] = np.array([row[8] for row in self.tile_index_rows], dtype=np.str_)
+        tile_index['offset'] = np.array([row[9] for row in self.tile_index_rows], dtype=np.int64)
+        return tile_index
+
+    def write_tile_index_shard(self, crops_dir):
+        """Write the statistics of the tile z-planes since the last checkpoint to a new tile index shard. Each
+        checkpoint only writes its own rows, and the shards are merged into the tile index file once, at exit."""
+        if len(self.tile_index_rows) == 0:
+            self.__remove_pending_tiles(crops_dir)
+            return
+        if self.tile_index_shard_number is None:
+            # Shards left by a killed run are merged after the shards of this run
+            shard_paths = self._get_tile_index_shard_paths(crops_dir)
+            self.tile_index_shard_number = 0
+            if len(shard_paths) > 0:
+                shard_name = os.path.basename(shard_paths[-1])
+                self.tile_index_shard_number = int(self.TILE_INDEX_SHARD_PATTERN.match(shard_name).group(1)) + 1
+
+        shard_file_path = os.path.join(crops_dir, 'tile_index_' + str(self.tile_index_shard_number) + '.npz')
+        logger.info(self.input_filename + ": Writing tile index shard to " + shard_file_path)
+        partial_file_path = os.path.join(crops_dir, 'tile_index_' + str(self.tile_index_shard_number) + '.part.npz')
+        np.savez(partial_file_path, **self._get_tile_index_rows_arrays())
+        os.replace(partial_file_path, shard_file_path)
+        self.tile_index_shard_number += 1
+        self.tile_index_rows = []
+        self.__remove_pending_tiles(crops_dir)
+
+    def write_tile_index(self, crops_dir):
+        """Merge the tile index shards and the statistics of the tile z-planes since the last checkpoint into the tile
+        index file of the crops directory, keeping the latest statistics of each tile z-plane."""
+        shard_paths = self._get_tile_index_shard_paths(crops_dir)
+        if len(self.tile_index_rows) == 0 and len(shard_paths) == 0:
+            self.__remove_pending_tiles(crops_dir)
+            return
+
+        tile_index_file_path = os.path.join(crops_dir, 'tile_index.npz')
+        tile_index_file_paths = [tile_index_file_path] if os.path.exists(tile_index_file_path) else []
+        tile_index_parts = []
+        for file_path in tile_index_file_paths + shard_paths:
+            with np.load(file_path) as tile_index_part:
+                tile_index_parts.append({key: tile_index_part[key] for key in tile_index_part.files})
+        if len(self.tile_index_rows) > 0:
+            tile_index_parts.append(self._get_tile_index_rows_arrays())
+        tile_index = {key: np.concatenate([part[key] for part in tile_index_parts])
+                      for key in tile_index_parts[-1].keys()}
+
+        if len(tile_index_parts) > 1:
+            # Keep the latest statistics of each tile z-plane
+            xyz = np.stack([tile_index['x'], tile_index['y'], tile_index['z']], axis=1)
+            _, last_reversed_indices = np.unique(xyz[::-1], axis=0, return_index=True)
+            keep_indices = np.sort(len(xyz) - 1 - last_reversed_indices)
+            for key in tile_index.keys():
+                tile_index[key] = tile_index[key][keep_indices]
+
+        logger.info(self.input_filename + ": Writing tile index to " + tile_index_file_path)
+        partial_file_path = os.path.join(crops_dir, 'tile_index.part.npz')
+        np.savez_compressed(partial_file_path, **tile_index)
+        os.replace(partial_file_path, tile_index_file_path)
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+        self.tile_index_rows = []
+        self.__remove_pending_tiles(crops_dir)
+
+    def __check_existing_metadata(self, crops_dir_metadata_file_path, scale, level):
+        """Check that the existing tiles were cropped at the same scale and pyramid level, and keep the metrics of the
+        previous runs. Tiles are named using full resolution coordinates, so tiles cropped at another scale would
+        otherwise be taken as already done."""
+        if not os.path.exists(crops_dir_metadata_file_path):
+            return
+        with open(crops_dir_metadata_file_path, 'r') as f:
+            existing_metadata = json.load(f)
+        self.previous_metrics = existing_metadata.get('metrics')
+        # Metadata written before the scale and level were recorded is from full resolution runs
+        existing_scale = existing_metadata.get('scale', 1.0)
+        existing_level_index = existing_metadata.get('level', {'index': 0})['index']
+        if abs(existing_scale - scale) > 1e-6 or existing_level_index != level['index']:
+            raise ValueError(self.input_filename + ": Existing tiles were cropped at scale " + str(existing_scale)
+                             + " from level " + str(existing_level_index) + ", not at scale " + str(scale)
+                             + " from level " + str(level['index']) + ". Use a different output directory.")
+
     def crop_tiles(self):
         """Crop tiles from an NDPISlide."""
         logger.info(self.input_filename + ": Crop tiles from NDPISlide")
+        self.crop_start_time = time.time()
         img_name = os.path.basename(self.input_file_path).split(' ')[0].rsplit('.', maxsplit=1)[0]
         # core_name = self.input_file.split('/')[-2].split('_')[0]
         crops_dir = str(os.path.join(self.output_dir, img_name))
@@ -184,19 +733,16 @@ class NDPIFileCropper:
 
         width = self._get_tile_size()
         height = self._get_tile_size()
-        overlap = self._get_tile_overlap()
-
-        # Find total number of image stacks
-        start_x_list = np.arange(0, self.metadata['width'] - width, width - overlap).tolist()
-        start_y_list = np.arange(0, self.metadata['height'] - height, height - overlap).tolist()
-        start_xy_list = []
+        scale, level = self._select_level()
+        # Remaining scaling after reading from the pyramid level
+        residual_scale = scale / level['downsample']
+        read_width = int(round(width * residual_scale))
+        read_height = int(round(height * residual_scale))
+        logger.info(self.input_filename + ": Reading tiles from pyramid level " + str(level['index']) + " (series "
+                    + str(level['series']) + ") at scale " + str(scale))
 
-        for i in range(len(start_x_list)):
-            for j in range(len(start_y_list)):
-                x = start_x_list[i]
-                y = start_y_list[j]
-                xy = (x, y)
-                start_xy_list.append(xy)
+        # Find total number of image stacks. The grid is laid out in output (scaled) coordinates.
+        start_xy_list = self._get_start_xy_list(scale, level)
 
         logger.info(self.input_filename + ": Number of tiles: " + str(len(start_xy_list)))
         self.total_tile_count = len(start_xy_list)
@@ -204,6 +750,14 @@ class NDPIFileCropper:
         crops_dir_metadata_dict = dict()
         crops_dir_metadata_dict['tile_size'] = self.tile_size
         crops_dir_metadata_dict['tile_overlap'] = self.tile_overlap
+        crops_dir_metadata_dict['scale'] = scale
+        crops_dir_metadata_dict['level'] = level
+        crops_dir_metadata_dict['traversal'] = self.traversal
+        crops_dir_metadata_dict['align_to_native'] = self.align_to_native
+        crops_dir_metadata_dict['tile_step'] = self._get_tile_step(scale, level)
+        crops_dir_metadata_dict['tile_index'] = {'file': 'tile_index.npz',
+                                                 'tissue_intensity_threshold': self.TISSUE_INTENSITY_THRESHOLD,
+                                                 'empty_tissue_fraction': self.EMPTY_TISSUE_FRACTION}
         crops_dir_metadata_dict['ome_metadata'] = self.metadata
         crops_dir_metadata_dict['total_tile_count'] = self.total_tile_count
         crops_dir_metadata_dict['processed_tile_count'] = 0
@@ -211,33 +765,115 @@ class NDPIFileCropper:
 
         crops_dir_metadata_file_path = os.path.join(crops_dir, 'metadata.json')
 
-        # Write metadata to the crops directory if it does not exist
-        if not os.path.exists(crops_dir_metadata_file_path):
-            with open(crops_dir_metadata_file_path, 'w') as f:
-                json.dump(crops_dir_metadata_dict, f, indent=4)
-
-        for i in range(len(start_xy_list)):
-            start_x = start_xy_list[i][0]
-            start_y = start_xy_list[i][1]
-            tile_dir = os.path.join(str(crops_dir), str(start_x) + 'x_' + str(start_y) + 'y')
-            if not os.path.exists(tile_dir):
-                os.makedirs(tile_dir)
-
-            z_plane_image_count = self.__count_files(tile_dir, self.tile_format)
-            # Proceed only if the number of z-plane images is less than the number of z-planes in the image or if the
-            # overwrite flag is set
-            if z_plane_image_count < self.metadata['z_plane'] or self.overwrite_flag:
+        # In zip mode, the tiles are appended to the zip file directly. Only the zip file central directory is read
+        # to find the existing tiles.
+        zip_file = None
+        zip_prefix = ''
+        existing_zip_entries = set()
+        tiles_since_checkpoint = 0
+        try:
+            if self.zip_flag:
+                zip_file, zip_prefix = self.__open_tiles_zip_file(crops_dir, img_name, self.overwrite_flag)
+                existing_zip_entries = set(zip_file.namelist())
+
+            self.__check_existing_metadata(crops_dir_metadata_file_path, scale, level)
+            # Only the tiles written after the last checkpoint of a killed run are missing from the tile index, unless
+            # the existing tiles are indexed on request, e.g., for outputs of versions without the tile index
+            for start_x, start_y in sorted(self._get_pending_tiles(crops_dir)):
+                tile_name = str(start_x) + 'x_' + str(start_y) + 'y'
                 for j in range(self.metadata['z_plane']):
-                    img = self.__read_tile(x=start_x, y=start_y, z=j, width=width, height=height)
-                    if img is not None:
-                        im = Image.fromarray(img)
-                        im.save(os.path.join(tile_dir, str(j) + 'z.png'))
-            else:
-                logger.info(self.input_filename + ": Tile " + str(i) + " already exists. Skipping...")
-            self.processed_tile_count += 1
-            logger.info(self.input_filename + ": Tile " + str(i) + " complete.")
+                    self.__index_existing_tile_plane(crops_dir, zip_file, zip_prefix, tile_name, start_x, start_y, j)
+            self.write_tile_index_shard(crops_dir)
+            if self.index_existing_tiles:
+                indexed_tile_planes = self._get_indexed_tile_planes(crops_dir)
+
+            # Write metadata to the crops directory if it does not exist
+            if not os.path.exists(crops_dir_metadata_file_path):
+                with open(crops_dir_metadata_file_path, 'w') as f:
+                    json.dump(crops_dir_metadata_dict, f, indent=4)
+
+            for i in range(len(start_xy_list)):
+                # Tile directories are named using full resolution coordinates
+                start_x = int(round(start_xy_list[i][0] * scale))
+                start_y = int(round(start_xy_list[i][1] * scale))
+                # Tile position in the pyramid level coordinates
+                level_x = min(int(round(start_xy_list[i][0] * residual_scale)), level['width'] - read_width)
+                level_y = min(int(round(start_xy_list[i][1] * residual_scale)), level['height'] - read_height)
+                tile_name = str(start_x) + 'x_' + str(start_y) + 'y'
+                tile_dir = os.path.join(str(crops_dir), tile_name)
+
+                if zip_file is not None:
+                    # Proceed only with the z-planes that are missing from the zip file
+                    z_plane_list = [j for j in range(self.metadata['z_plane'])
+                                    if zip_prefix + tile_name + '/' + str(j) + 'z.png' not in existing_zip_entries]
+                else:
+                    if not os.path.exists(tile_dir):
+                        os.makedirs(tile_dir)
+                    z_plane_image_count = self.__count_files(tile_dir, self.tile_format)
+                    # Proceed only if the number of z-plane images is less than the number of z-planes in the image or
+                    # if the overwrite flag is set
+                    if z_plane_image_count < self.metadata['z_plane'] or self.overwrite_flag:
+                        z_plane_list = list(range(self.metadata['z_plane']))
+                    else:
+                        z_plane_list = []
+
+                tile_index_row_count = len(self.tile_index_rows)
+                if self.index_existing_tiles:
+                    for j in range(self.metadata['z_plane']):
+                        if j not in z_plane_list and (start_x, start_y, j) not in indexed_tile_planes:
+                            self.__index_existing_tile_plane(crops_dir, zip_file, zip_prefix, tile_name, start_x,
+                                                             start_y, j)
+
+                if len(z_plane_list) > 0:
+                    self.__add_pending_tile(crops_dir, start_x, start_y)
+                    for j in z_plane_list:
+                        img = self.__read_tile(x=level_x, y=level_y, z=j, width=read_width, height=read_height,
+                                               series=level['series'])
+                        if img is not None:
+                            tile = self._resample_tile(img, width, height)
+                            im = Image.fromarray(tile)
+                            tile_path = tile_name + '/' + str(j) + 'z.png'
+                            if zip_file is not None:
+                                tile_bytes = io.BytesIO()
+                                im.save(tile_bytes, format='PNG')
+                                zip_file.writestr(zip_prefix + tile_path, tile_bytes.getvalue())
+                                self.bytes_written += tile_bytes.tell()
+                                tile_offset = zip_file.getinfo(zip_prefix + tile_path).header_offset
+                            else:
+                                tile_file_path = os.path.join(tile_dir, str(j) + 'z.png')
+                                im.save(tile_file_path)
+                                self.bytes_written += os.path.getsize(tile_file_path)
+                                tile_offset = -1
+                            self.tile_planes_written += 1
+
+                            mean, std, tissue_fraction, focus_score, empty = self._compute_tile_statistics(tile)
+                            self.tile_index_rows.append((start_x, start_y, j, mean, std, tissue_fraction, focus_score,
+                                                         empty, zip_prefix + tile_path, tile_offset))
+                else:
+                    logger.info(self.input_filename + ": Tile " + str(i) + " already exists. Skipping...")
+
+                if len(self.tile_index_rows) > tile_index_row_count:
+                    tiles_since_checkpoint += 1
+                if tiles_since_checkpoint >= self.CHECKPOINT_TILE_COUNT:
+                    if zip_file is not None:
+                        logger.info(self.input_filename + ": Checkpointing zip file")
+                        self.__close_tiles_zip_file(zip_file)
+                        zip_file = None
+                        zip_file, zip_prefix = self.__open_tiles_zip_file(crops_dir, img_name)
+                    # The tile index shard is written once its tiles are in a complete zip file
+                    self.write_tile_index_shard(crops_dir)
+                    tiles_since_checkpoint = 0
+                self.processed_tile_count += 1
+                logger.info(self.input_filename + ": Tile " + str(i) + " complete.")
+        finally:
+            # Closing the zip file writes its central directory
+            if zip_file is not None:
+                self.__close_tiles_zip_file(zip_file)
 
     def write_metadata_before_exiting(self):
+        # Nothing to update if tile cropping has not started, e.g., in plan mode
+        if self.crop_start_time is None:
+            return
         crops_dir = str(os.path.join(self.output_dir, os.path.basename(self.input_file_path).split(' ')[0].rsplit('.', maxsplit=1)[0]))
         crops_dir_metadata_file_path = os.path.join(crops_dir, 'metadata.json')
         if os.path.exists(crops_dir_metadata_file_path):
@@ -250,48 +886,130 @@ class NDPIFileCropper:
                 else:
                     # Calculate the percentage of tiles processed
                     existing_metadata['percent_complete'] = round((self.processed_tile_count / self.total_tile_count) * 100, 2)
+                if self.tile_planes_written > 0:
+                    existing_metadata['metrics'] = self._get_metrics()
             with open(crops_dir_metadata_file_path, 'w') as f:
                 logger.info(self.input_filename + ": Writing metadata to " + crops_dir_metadata_file_path)
                 json.dump(existing_metadata, f, indent=4)
+            self.write_tile_index(crops_dir)
         else:
             logger.error(self.input_filename + ": Metadata file not found. Exiting without updating metadata.")
 
+    def __open_tiles_zip_file(self, crops_dir_path, img_name, overwrite=False):
+        """Open the tiles zip file for appending, or create it if it does not exist or if overwrite is set. The metadata
+        and the tile index of the previous run are restored to the crops directory and removed from the end of the zip
+        file. Appending overwrites the zip file central directory, so the end of the zip file is saved to a journal
+        first, and an interrupted run is rolled back to the last complete zip file on the next open. Returns the zip
+        file and the prefix of its entries."""
+        zip_file_path = crops_dir_path + '.zip'
+        journal_file_path = zip_file_path + '.journal'
+        if overwrite:
+            for file_path in [zip_file_path, journal_file_path]:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+        if os.path.exists(journal_file_path):
+            self.__rollback_tiles_zip_file(zip_file_path, journal_file_path)
+        if os.path.exists(zip_file_path):
+            logger.info(self.input_filename + ": Resuming from zip file " + zip_file_path)
+        else:
+            ZipFile(zip_file_path, 'w').close()
+
+        zip_file = ZipFile(zip_file_path, 'a')
+        zip_prefix = self.__get_zip_prefix(zip_file, img_name)
+        # Restore the metadata and the tile index of the previous run
+        for file in self.ZIP_TRAILING_FILES:
+            file_path = os.path.join(crops_dir_path, file)
+            if not os.path.exists(file_path) and zip_prefix + file in zip_file.NameToInfo:
+                with open(file_path, 'wb') as f:
+                    f.write(zip_file.read(zip_prefix + file))
+        self.__remove_trailing_zip_entries(zip_file, [zip_prefix + name for name in self.ZIP_TRAILING_FILES])
+
+        # The journal holds the offset of the first appended entry and the original bytes from that offset on
+        with open(zip_file_path, 'rb') as f:
+            f.seek(zip_file.start_dir)
+            zip_file_tail = f.read()
+        partial_file_path = journal_file_path + '.part'
+        with open(partial_file_path, 'wb') as f:
+            f.write(struct.pack('<Q', zip_file.start_dir))
+            f.write(zip_file_tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(partial_file_path, journal_file_path)
+        return zip_file, zip_prefix
+
+    def __rollback_tiles_zip_file(self, zip_file_path, journal_file_path):
+        """Restore the zip file saved in the journal by an interrupted run. The entries appended by that run after its
+        last checkpoint are discarded."""
+        logger.warning(self.input_filename + ": Rolling back the zip file " + zip_file_path
+                       + " to its last checkpoint")
+        with open(journal_file_path, 'rb') as f:
+            offset = struct.unpack('<Q', f.read(8))[0]
+            zip_file_tail = f.read()
+        with open(zip_file_path, 'r+b') as f:
+            f.truncate(offset)
+            f.seek(offset)
+            f.write(zip_file_tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.remove(journal_file_path)
+
+    @staticmethod
+    def __close_tiles_zip_file(zip_file):
+        """Close the tiles zip file, which writes its central directory, and remove its journal."""
+        zip_file_path = zip_file.filename
+        zip_file.close()
+        with open(zip_file_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.remove(zip_file_path + '.journal')
+
+    @staticmethod
+    def __get_zip_prefix(zip_file, img_name):
+        """Get the prefix of the zip file entries. Zip files created by other tools may contain the image name
+        directory."""
+        for name in zip_file.namelist():
+            if name.startswith(img_name + '/'):
+                return img_name + '/'
+        return ''
+
+    @staticmethod
+    def __remove_trailing_zip_entries(zip_file, names):
+        """Remove the given entries from the end of a zip file opened for appending, so that they can be written again
+        without duplicates. The following writes overwrite the removed entries. Entries that are not at the end of the
+        zip file are kept, and the last written entry takes precedence when reading."""
+        while len(zip_file.filelist) > 0 and zip_file.filelist[-1].filename in names:
+            zip_info = zip_file.filelist.pop()
+            del zip_file.NameToInfo[zip_info.filename]
+            for earlier_zip_info in reversed(zip_file.filelist):
+                if earlier_zip_info.filename == zip_info.filename:
+                    zip_file.NameToInfo[zip_info.filename] = earlier_zip_info
+                    break
+            zip_file.start_dir = zip_info.header_offset
+
     def zip_tiles(self):
-        """Zip the tiles output directory and remove the directory."""
+        """Add the tiles output directory contents to the zip file and remove the directory."""
         img_name = os.path.basename(self.input_file_path).split(' ')[0].rsplit('.', maxsplit=1)[0]
         crops_dir_path = str(os.path.join(self.output_dir, img_name))
         zip_file_path = crops_dir_path + '.zip'
-        with ZipFile(zip_file_path, 'w') as zip_file:
+        zip_file, zip_prefix = self.__open_tiles_zip_file(crops_dir_path, img_name)
+        try:
+            existing_zip_entries = set(zip_file.namelist())
             for root, dirs, files in os.walk(crops_dir_path):
                 for file in files:
-                    zip_file.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), crops_dir_path))
-            logger.info(self.input_filename + ": Zipped tiles to " + crops_dir_path + '.zip')
-            logger.info(self.input_filename + ": Removing directory " + crops_dir_path)
-            shutil.rmtree(crops_dir_path)
-
-    def unzip_tiles(self):
-        """Unzip the tiles output directory."""
-        img_name = os.path.basename(self.input_file_path).split(' ')[0].rsplit('.', maxsplit=1)[0]
-        crops_dir_path = str(os.path.join(self.output_dir, img_name))
-        zip_file_path = crops_dir_path + '.zip'
-
-        # If the crops directory already exists, give priority to that and skip unzipping
-        if os.path.exists(crops_dir_path):
-            logger.info(self.input_filename + ": Directory " + crops_dir_path + " already exists. Skipping unzipping...")
-            return
-
-        if os.path.exists(zip_file_path):
-            with ZipFile(zip_file_path, 'r') as zip_file:
-                for info in zip_file.infolist():
-                    # Check if the zip file contents starts with the image name
-                    if info.filename.startswith(img_name + '/'):
-                        zip_file.extractall(self.output_dir)
-                        logger.info(self.input_filename + ": Unzipped tiles to " + crops_dir_path)
-                    else:
-                        zip_file.extractall(crops_dir_path)
-                        logger.info(self.input_filename + ": Unzipped tiles to " + crops_dir_path)
-        else:
-            logger.info(self.input_filename + ": Zip file not found. Skipping unzipping...")
+                    file_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(file_path, crops_dir_path).replace(os.sep, '/')
+                    # Tiles written to the directory by an earlier run
+                    if relative_path not in self.ZIP_TRAILING_FILES and zip_prefix + relative_path not in existing_zip_entries:
+                        zip_file.write(file_path, zip_prefix + relative_path)
+            # Write the files that are rewritten on every run last
+            for file in self.ZIP_TRAILING_FILES:
+                file_path = os.path.join(crops_dir_path, file)
+                if os.path.exists(file_path):
+                    zip_file.write(file_path, zip_prefix + file)
+        finally:
+            self.__close_tiles_zip_file(zip_file)
+        logger.info(self.input_filename + ": Zipped tiles to " + zip_file_path)
+        logger.info(self.input_filename + ": Removing directory " + crops_dir_path)
+        shutil.rmtree(crops_dir_path)
 
     def _get_tile_size(self):
         """Get the tile size."""
@@ -315,10 +1033,31 @@ class NDPIFileCropper:
         exit(0)
 
 
-if __name__ == '__main__':
+def plan_tiles(ndpi_file_cropper, calibration_file_path=None, plan_file_path=None):
+    """Write the JSON plan of an NDPISlide without reading any tiles."""
+    # The JVM is only needed if the metadata is not cached
+    if not ndpi_file_cropper.load_cached_metadata():
+        javabridge.start_vm(class_path=bioformats.JARS, run_headless=True)
+        try:
+            logback.basic_config()
+            ndpi_file_cropper.read_metadata()
+            ndpi_file_cropper.save_cached_metadata()
+        finally:
+            javabridge.kill_vm()
 
-    # Start the JVM
-    javabridge.start_vm(class_path=bioformats.JARS, run_headless=True)
+    calibration = None
+    if calibration_file_path is not None:
+        calibration = NDPIFileCropper.load_calibration(calibration_file_path)
+
+    plan = ndpi_file_cropper.plan(calibration)
+    if plan_file_path is None:
+        print(json.dumps(plan, indent=4))
+    else:
+        with open(plan_file_path, 'w') as f:
+            json.dump(plan, f, indent=4)
+
+
+if __name__ == '__main__':
 
     # Parse the command line arguments
     cli = NDPITileCropperCLI()
@@ -332,7 +1071,25 @@ if __name__ == '__main__':
 
     # Create an NDPIFileCropper instance
     ndpi_file_cropper = NDPIFileCropper(cli.args.input_file, cli.args.output_dir, cli.args.tile_size,
-                                        cli.args.tile_overlap, cli.args.tile_format, cli.args.overwrite)
+                                        cli.args.tile_overlap, cli.args.tile_format, cli.args.overwrite, cli.args.zip,
+                                        scale=cli.args.scale, mpp=cli.args.mpp, level=cli.args.level,
+                                        traversal=cli.args.traversal, align_to_native=cli.args.align_to_native,
+                                        cache_dir=cli.args.cache_dir,
+                                        index_existing_tiles=cli.args.index_existing_tiles)
+
+    if cli.args.plan:
+        plan_tiles(ndpi_file_cropper, cli.args.calibration, cli.args.plan_output)
+        logger.info("Stopping NDPITileCropper CLI")
+        exit(0)
+
+    # Stage the NDPISlide to the local scratch directory
+    slide_staging_cache = None
+    if cli.args.scratch_dir:
+        slide_staging_cache = SlideStagingCache(cli.args.scratch_dir, int(cli.args.scratch_size * 1024 ** 3))
+        ndpi_file_cropper.read_file_path = slide_staging_cache.stage(cli.args.input_file)
+
+    # Start the JVM
+    javabridge.start_vm(class_path=bioformats.JARS, run_headless=True)
 
     try:
         logback.basic_config()
@@ -340,17 +1097,13 @@ if __name__ == '__main__':
         # Read the metadata of the NDPISlide
         ndpi_file_cropper.read_metadata()
 
-        # Unzip the tiles directory if the zip flag is set and if the zip file exists
-        if cli.args.zip:
-            ndpi_file_cropper.unzip_tiles()
-
         # Crop tiles from the NDPISlide
         ndpi_file_cropper.crop_tiles()
 
         # Write metadata before exiting
         ndpi_file_cropper.write_metadata_before_exiting()
 
-        # Zip the tiles directory if the zip flag is set
+        # Add the metadata and any remaining tiles in the tiles directory to the zip file if the zip flag is set
         if cli.args.zip:
             ndpi_file_cropper.zip_tiles()
 
@@ -364,4 +1117,9 @@ if __name__ == '__main__':
         # Stop the JVM
         logger.info("Shutting down JVM.")
         javabridge.kill_vm()
+
+        # Make the staged copy available for eviction
+        if slide_staging_cache is not None:
+            slide_staging_cache.release(cli.args.input_file)
+            slide_staging_cache.close()
         logger.info("Stopping NDPITileCropper CLI")
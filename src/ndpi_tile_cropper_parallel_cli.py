@@ -15,9 +15,14 @@
 
 import argparse
 import concurrent.futures
+import heapq
+import json
 import logging
 import os
 import subprocess
+import tempfile
+
+from slide_staging import SlideStagingCache
 
 
 class NDPITileCropperParallelCLI(object):
@@ -28,6 +33,7 @@ class NDPITileCropperParallelCLI(object):
         """Initialize an NDPITileCropperParallelCLI instance."""
         self.parser = self._create_parser()
         self.args = None
+        self.slide_staging_cache = None
 
     def parse_args(self):
         """Parse the command line arguments."""
@@ -69,6 +75,44 @@ class NDPITileCropperParallelCLI(object):
             default=0,
             required=False,
             help='Overlap of the tiles in pixels.')
+        resolution_group = parser.add_mutually_exclusive_group()
+        resolution_group.add_argument(
+            '--scale',
+            type=float,
+            default=None,
+            help='Downsampling factor relative to the full resolution image. E.g., 4 to crop 10x tiles from a 40x slide. '
+                 'Tiles are read from the closest pyramid level and resampled if needed.')
+        resolution_group.add_argument(
+            '--mpp',
+            type=float,
+            default=None,
+            help='Target resolution in microns per pixel. Tiles are read from the closest pyramid level and resampled '
+                 'if needed.')
+        parser.add_argument(
+            '--level',
+            type=int,
+            default=None,
+            help='Pyramid level to read the tiles from. 0 is the full resolution image. If not provided, the level is '
+                 'chosen using --scale or --mpp.')
+        parser.add_argument(
+            '--traversal', '-t',
+            default='row',
+            choices=['row', 'column', 'block', 'hilbert'],
+            help='Order in which the tiles are read. row: row by row, following the slide storage layout. column: column '
+                 'by column. block: native tile by native tile of the slide. hilbert: along a Hilbert curve.')
+        parser.add_argument(
+            '--align-to-native', '-a',
+            action='store_true',
+            help='Round the tile step down to a multiple of the native tile size of the slide, so that all the tiles '
+                 'start on native tile boundaries. The tile overlap grows accordingly. Ignored when the native tiles '
+                 'are larger than the tile step.')
+        parser.add_argument(
+            '--index-existing-tiles',
+            action='store_true',
+            help='Compute the statistics of the existing tiles that are missing from the tile index, e.g., tiles '
+                 'cropped by a version without the tile index. Every such tile is decoded, which can take long. '
+                 'Without this option, only the tiles written after the last tile index checkpoint of a killed run '
+                 'are indexed.')
         parser.add_argument(
             '--num_processes', '-n',
             type=int,
@@ -81,7 +125,43 @@ class NDPITileCropperParallelCLI(object):
         parser.add_argument(
             '--zip', '-z',
             action='store_true',
-            help='Zip the tiles output directory and remove the tiles directory. Unzip the tiles directory zip file, if it exists, before starting with the tiles creation.')
+            help='Write the tiles to a zip file instead of the tiles output directory. If the zip file exists, only the missing tiles are cropped and appended to it. A killed run is rolled back to its last checkpoint on the next run.')
+        parser.add_argument(
+            '--scratch-dir',
+            nargs='?', default=None, required=False,
+            help='Path to a local scratch directory. If provided, the input files are copied there ahead of processing '
+                 'and read from the local copies. E.g., /scratch/ndpi')
+        parser.add_argument(
+            '--scratch-size',
+            type=float,
+            default=100,
+            help='Maximum size of the staged copies in GB. The least recently used copies are removed to stay under '
+                 'this size. Other files in the scratch directory are not counted or removed.')
+        parser.add_argument(
+            '--prefetch-depth',
+            type=int,
+            default=2,
+            help='Number of upcoming input files to copy to the scratch directory while the current files are processed.')
+        parser.add_argument(
+            '--plan', '-p',
+            action='store_true',
+            help='Only read the metadata of each file and print a JSON plan with the number of tiles, the predicted '
+                 'output size and the predicted wall time for the given number of processes. No tiles are read or '
+                 'written.')
+        parser.add_argument(
+            '--plan-output',
+            nargs='?', default=None, required=False,
+            help='Path to write the JSON plan to. If not provided, the plan is printed to the standard output.')
+        parser.add_argument(
+            '--cache-dir',
+            nargs='?', default=None, required=False,
+            help='Path to the directory where --plan caches the metadata of the input files. Defaults to '
+                 '$XDG_CACHE_HOME/ndpi-tile-cropper or ~/.cache/ndpi-tile-cropper.')
+        parser.add_argument(
+            '--calibration',
+            nargs='?', default=None, required=False,
+            help='Path to a calibration file used by --plan to predict the output size and processing time. This can be '
+                 'the metadata.json file of a previous run. E.g., data/NDPI/NDPI_1_tiles/NDPI_1/metadata.json')
         parser.add_argument(
             '--log-level', '-g',
             type=str,
@@ -104,18 +184,47 @@ class NDPITileCropperParallelCLI(object):
                 input_files.append(os.path.join(self.args.input_dir, file))
         return input_files
 
-    def __process_file(self, input_file):
-        """Process a file."""
-        logger.info("Started processing file: {}".format(input_file))
+    def _get_output_dir(self, input_file, create=True):
+        """Get the output directory of a file, and create it if create is set."""
         if self.args.output_dir:
             output_dir = self.args.output_dir
         else:
             output_dir = os.path.splitext(input_file)[0] + "_tiles"
-        if not os.path.exists(output_dir):
+        if create and not os.path.exists(output_dir):
             os.makedirs(output_dir)
+        return output_dir
+
+    def _get_command(self, input_file, output_dir):
+        """Get the ndpi_tile_cropper_cli.py command to process a file."""
         command = ["python", "ndpi_tile_cropper_cli.py", "-i", input_file, "-o", output_dir, "-s", str(self.args.tile_size),
                    "-l", str(self.args.tile_overlap), "-g", str(self.args.log_level)]
 
+        if self.args.scale is not None:
+            command.extend(["--scale", str(self.args.scale)])
+        if self.args.mpp is not None:
+            command.extend(["--mpp", str(self.args.mpp)])
+        if self.args.level is not None:
+            command.extend(["--level", str(self.args.level)])
+        command.extend(["-t", self.args.traversal])
+        if self.args.align_to_native:
+            command.append("-a")
+        if self.args.index_existing_tiles:
+            command.append("--index-existing-tiles")
+        return command
+
+    def __process_file(self, input_file, upcoming_input_files):
+        """Process a file."""
+        logger.info("Started processing file: {}".format(input_file))
+        output_dir = self._get_output_dir(input_file)
+
+        # Read the file from its staged copy, and stage the upcoming files in the background
+        read_file = input_file
+        if self.slide_staging_cache is not None:
+            read_file = self.slide_staging_cache.stage(input_file)
+            self.slide_staging_cache.prefetch(upcoming_input_files)
+
+        command = self._get_command(read_file, output_dir)
+
         if self.args.overwrite:
             command.append("-w")
         if self.args.zip:
@@ -123,19 +232,97 @@ class NDPITileCropperParallelCLI(object):
         if self.args.verbose:
             command.append("-v")
 
-        result = subprocess.run(command)
-        logger.info(result)
+        try:
+            result = subprocess.run(command)
+            logger.info(result)
+        finally:
+            if self.slide_staging_cache is not None:
+                self.slide_staging_cache.release(input_file)
         logger.info("Finished processing file: {}".format(input_file))
 
     def process_files_in_parallel(self):
         """Process the files in parallel."""
         logger.info("Started processing files in parallel")
         input_files = self._get_input_files()
+        if self.args.scratch_dir:
+            self.slide_staging_cache = SlideStagingCache(self.args.scratch_dir, int(self.args.scratch_size * 1024 ** 3),
+                                                         self.args.prefetch_depth)
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.num_processes) as executor:
-            for input_file in input_files:
-                executor.submit(self.__process_file, input_file)
+            for i, input_file in enumerate(input_files):
+                # The files after the ones being processed by the other processes are the next to start
+                next_index = i + self.args.num_processes
+                executor.submit(self.__process_file, input_file,
+                                input_files[next_index:next_index + self.args.prefetch_depth])
+        if self.slide_staging_cache is not None:
+            self.slide_staging_cache.close()
         logger.info("Finished processing files in parallel")
 
+    def __plan_file(self, input_file):
+        """Plan a file. Returns the JSON plan, or None if planning failed."""
+        logger.info("Started planning file: {}".format(input_file))
+        # Planning has no side effects on the output directories
+        output_dir = self._get_output_dir(input_file, create=False)
+        with tempfile.TemporaryDirectory() as plan_dir:
+            plan_file_path = os.path.join(plan_dir, "plan.json")
+            command = self._get_command(input_file, output_dir) + ["--plan", "--plan-output", plan_file_path]
+            if self.args.cache_dir:
+                command.extend(["--cache-dir", self.args.cache_dir])
+            if self.args.calibration:
+                command.extend(["--calibration", self.args.calibration])
+
+            result = subprocess.run(command)
+            if result.returncode != 0 or not os.path.exists(plan_file_path):
+                logger.error("Failed planning file: {}".format(input_file))
+                return None
+            with open(plan_file_path, 'r') as f:
+                return json.load(f)
+
+    @staticmethod
+    def _get_predicted_wall_seconds(slide_seconds_list, workers):
+        """Predict the wall time of processing the files in order, each on the first available worker."""
+        worker_available_times = [0.0] * workers
+        for slide_seconds in slide_seconds_list:
+            start_time = heapq.heappop(worker_available_times)
+            heapq.heappush(worker_available_times, start_time + slide_seconds)
+        return max(worker_available_times)
+
+    def plan_files_in_parallel(self):
+        """Plan the files in parallel and write the combined JSON plan."""
+        logger.info("Started planning files in parallel")
+        input_files = self._get_input_files()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.num_processes) as executor:
+            plans = list(executor.map(self.__plan_file, input_files))
+        plans = [plan for plan in plans if plan is not None]
+
+        predicted_bytes = dict()
+        for plan in plans:
+            for tile_format, format_bytes in plan['predicted_bytes'].items():
+                predicted_bytes[tile_format] = predicted_bytes.get(tile_format, 0) + format_bytes
+
+        slide_seconds_list = [plan['predicted_wall_seconds'] for plan in plans]
+        if len(plans) > 0 and None not in slide_seconds_list:
+            predicted_wall_seconds = round(self._get_predicted_wall_seconds(slide_seconds_list,
+                                                                            self.args.num_processes), 1)
+        else:
+            predicted_wall_seconds = None
+
+        combined_plan = dict()
+        combined_plan['file_count'] = len(plans)
+        combined_plan['failed_file_count'] = len(input_files) - len(plans)
+        combined_plan['tile_count'] = sum(plan['tile_count'] for plan in plans)
+        combined_plan['tile_plane_count'] = sum(plan['tile_plane_count'] for plan in plans)
+        combined_plan['predicted_bytes'] = predicted_bytes
+        combined_plan['workers'] = self.args.num_processes
+        combined_plan['predicted_wall_seconds'] = predicted_wall_seconds
+        combined_plan['files'] = plans
+
+        if self.args.plan_output:
+            with open(self.args.plan_output, 'w') as f:
+                json.dump(combined_plan, f, indent=4)
+        else:
+            print(json.dumps(combined_plan, indent=4))
+        logger.info("Finished planning files in parallel")
+
 
 if __name__ == '__main__':
     # Create an instance of the CLI and parse the arguments
@@ -147,5 +334,9 @@ if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(levelname)-7s : %(name)s - %(message)s', level=cli.args.log_level)
     logger = logging.getLogger("ndpi_tile_cropper_parallel_cli.py")
 
-    # Process the files in parallel
-    cli.process_files_in_parallel()
+    if cli.args.plan:
+        # Plan the files in parallel
+        cli.plan_files_in_parallel()
+    else:
+        # Process the files in parallel
+        cli.process_files_in_parallel()
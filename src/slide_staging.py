@@ -0,0 +1,283 @@
+#  Copyright 2024 The Board of Trustees of the University of Illinois. All Rights Reserved.
+#
+#  Licensed under the terms of Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  The License is included in the distribution as LICENSE file.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import concurrent.futures
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+
+logger = logging.getLogger("slide_staging.py")
+
+
+class SlideStagingCache(object):
+    """Stage NDPI files from network storage to a local scratch directory, so that the many small reads done by
+    Bio-Formats go to a local copy. Copies are made one at a time with large sequential reads, and the least recently
+    used copies are evicted to keep the staged copies under a size limit. The copies are kept in a sub-directory of the
+    scratch directory owned by the cache, and no other file of the scratch directory is counted or evicted.
+
+    Copies in use are locked with a shared file lock, and a copy is only evicted if an exclusive lock can be taken on
+    it, so that several processes can share the same scratch directory."""
+
+    # Name of the sub-directory of the scratch directory with the staged copies
+    CACHE_DIR_NAME = 'slide_staging_cache'
+
+    # Sub-directories of the cache directory, named after the hash of the source directory
+    STAGED_DIR_PATTERN = re.compile(r'^[0-9a-f]{12}$')
+
+    # Number of times a file is copied again if another process evicts it before it is locked
+    STAGE_ATTEMPTS = 3
+
+    def __init__(self, scratch_dir, max_bytes, prefetch_depth=2, chunk_size=64 * 1024 * 1024):
+        """Initialize a SlideStagingCache instance."""
+        self.scratch_dir = scratch_dir
+        self.cache_dir = os.path.join(scratch_dir, self.CACHE_DIR_NAME)
+        self.max_bytes = max_bytes
+        self.prefetch_depth = prefetch_depth
+        self.chunk_size = chunk_size
+
+        self._lock = threading.Lock()
+        # Staged copies in use, which must not be evicted, with their use counts
+        self._pinned = dict()
+        # File descriptors holding the shared locks of the staged copies in use
+        self._pin_fds = dict()
+        # Prefetched copies that have not been used yet
+        self._prefetched = set()
+        # Pending copies by source file path
+        self._copies = dict()
+        # A single copy thread keeps the copies sequential
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _get_staged_path(self, source_path):
+        """Get the path of the staged copy of a file. The file name is kept, and files with the same name in different
+        directories are staged in different sub-directories."""
+        source_dir = os.path.dirname(os.path.abspath(source_path))
+        source_dir_hash = hashlib.sha1(source_dir.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.cache_dir, source_dir_hash, os.path.basename(source_path))
+
+    @staticmethod
+    def _is_staged(source_path, staged_path):
+        """Check if the staged copy of a file exists and is up to date. Staged copies keep the size and modification
+        time of the source file."""
+        if not os.path.exists(staged_path):
+            return False
+        source_stat = os.stat(source_path)
+        staged_stat = os.stat(staged_path)
+        return staged_stat.st_size == source_stat.st_size and staged_stat.st_mtime == source_stat.st_mtime
+
+    @staticmethod
+    def _touch(staged_path):
+        """Mark a staged copy as recently used. The access time is used for the LRU order and the modification time
+        is kept for the up to date check."""
+        if os.path.exists(staged_path):
+            os.utime(staged_path, (time.time(), os.stat(staged_path).st_mtime))
+
+    @staticmethod
+    def _is_locked_file(fd, staged_path):
+        """Check if a locked file descriptor still refers to the file at the staged path, which is not the case if the
+        file was evicted or replaced before the lock was taken."""
+        try:
+            staged_stat = os.stat(staged_path)
+        except FileNotFoundError:
+            return False
+        fd_stat = os.fstat(fd)
+        return fd_stat.st_dev == staged_stat.st_dev and fd_stat.st_ino == staged_stat.st_ino
+
+    def _lock_staged_file(self, staged_path):
+        """Take a shared lock on a staged copy, so that no other process evicts it. Returns the locked file descriptor,
+        or None if the copy was evicted before the lock was taken."""
+        try:
+            fd = os.open(staged_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if not self._is_locked_file(fd, staged_path):
+            os.close(fd)
+            return None
+        return fd
+
+    def _remove_unused_file(self, staged_path):
+        """Remove a staged copy if no process has it locked. Returns False if the copy is in use."""
+        try:
+            fd = os.open(staged_path, os.O_RDONLY)
+        except FileNotFoundError:
+            return True
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            if not self._is_locked_file(fd, staged_path):
+                return False
+            os.remove(staged_path)
+            return True
+        finally:
+            os.close(fd)
+
+    def _get_staged_files(self):
+        """Get the access time, size and path of the staged copies. Only the complete copies written by the cache, with
+        a <hash>/<name> path in the cache directory, are listed."""
+        staged_files = []
+        for staged_dir in os.listdir(self.cache_dir):
+            staged_dir_path = os.path.join(self.cache_dir, staged_dir)
+            if not self.STAGED_DIR_PATTERN.match(staged_dir) or not os.path.isdir(staged_dir_path):
+                continue
+            for file in os.listdir(staged_dir_path):
+                file_path = os.path.join(staged_dir_path, file)
+                if file.endswith('.part') or not os.path.isfile(file_path):
+                    continue
+                file_stat = os.stat(file_path)
+                staged_files.append((file_stat.st_atime, file_stat.st_size, file_path))
+        return staged_files
+
+    def _evict(self, needed_bytes, keep_prefetched=False):
+        """Evict the least recently used staged copies that are not in use until needed_bytes fit in the cache.
+        Prefetched copies that have not been used yet are evicted last, and kept if keep_prefetched is set. Copies locked by other
+        processes are in use too. Returns False if needed_bytes do not fit even after evicting all the other copies."""
+        staged_files = self._get_staged_files()
+        total_bytes = sum(file_size for access_time, file_size, file_path in staged_files)
+
+        with self._lock:
+            evictable_files = sorted((f for f in staged_files if self._pinned.get(f[2], 0) == 0
+                                      and not (keep_prefetched and f[2] in self._prefetched)),
+                                     key=lambda f: (f[2] in self._prefetched, f[0]))
+
+        for access_time, file_size, file_path in evictable_files:
+            if total_bytes + needed_bytes <= self.max_bytes:
+                break
+            if not self._remove_unused_file(file_path):
+                continue
+            logger.info("Evicted staged file: {}".format(file_path))
+            total_bytes -= file_size
+            with self._lock:
+                self._prefetched.discard(file_path)
+
+        return total_bytes + needed_bytes <= self.max_bytes
+
+    def _copy(self, source_path, prefetch=False):
+        """Copy a file to the scratch directory, if it is not staged yet. Returns the staged path, or None if the file
+        does not fit in the cache. A prefetch does not evict the other prefetched copies."""
+        staged_path = self._get_staged_path(source_path)
+        if self._is_staged(source_path, staged_path):
+            return staged_path
+
+        source_stat = os.stat(source_path)
+        if not self._evict(source_stat.st_size, keep_prefetched=prefetch):
+            logger.warning("Not enough scratch space to stage file: {}".format(source_path))
+            return None
+
+        logger.info("Staging file: {} to {}".format(source_path, staged_path))
+        staged_dir = os.path.dirname(staged_path)
+        if not os.path.exists(staged_dir):
+            os.makedirs(staged_dir)
+        # Partial copies are named after the process, as other processes may stage the same file
+        partial_path = staged_path + '.' + str(os.getpid()) + '.part'
+        try:
+            with open(source_path, 'rb') as source_file, open(partial_path, 'wb') as staged_file:
+                shutil.copyfileobj(source_file, staged_file, self.chunk_size)
+            os.utime(partial_path, (time.time(), source_stat.st_mtime))
+            # Keep the copy of another process that finished first, as it may be in use
+            if not self._is_staged(source_path, staged_path):
+                os.replace(partial_path, staged_path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        if prefetch:
+            with self._lock:
+                self._prefetched.add(staged_path)
+        return staged_path
+
+    def _submit(self, source_path, prefetch=False):
+        """Submit a copy of a file, or get the pending copy of the file."""
+        with self._lock:
+            future = self._copies.get(source_path)
+            if future is None or future.done():
+                future = self._executor.submit(self._copy, source_path, prefetch)
+                self._copies[source_path] = future
+            return future
+
+    def prefetch(self, source_paths):
+        """Stage the next files in the background, up to the prefetch depth."""
+        for source_path in source_paths[:self.prefetch_depth]:
+            self._submit(source_path, prefetch=True)
+
+    def stage(self, source_path):
+        """Stage a file and mark it as in use until it is released. Returns the path to read the file from, which is
+        the source path if the file could not be staged."""
+        staged_path = self._get_staged_path(source_path)
+        with self._lock:
+            self._pinned[staged_path] = self._pinned.get(staged_path, 0) + 1
+
+        fd = None
+        try:
+            for attempt in range(self.STAGE_ATTEMPTS):
+                if self._submit(source_path).result() is None:
+                    break
+                with self._lock:
+                    if staged_path in self._pin_fds:
+                        break
+                fd = self._lock_staged_file(staged_path)
+                if fd is not None:
+                    break
+                logger.info("Staged file evicted by another process, staging again: {}".format(source_path))
+        except Exception as e:
+            logger.error("Failed staging file: {}".format(source_path))
+            logger.error(e, exc_info=True)
+
+        # The copy may come from a prefetch, but it is now in use
+        with self._lock:
+            self._prefetched.discard(staged_path)
+            if fd is not None:
+                if staged_path in self._pin_fds:
+                    os.close(fd)
+                else:
+                    self._pin_fds[staged_path] = fd
+            is_locked = staged_path in self._pin_fds
+
+        if not is_locked:
+            self.release(source_path)
+            return source_path
+        self._touch(staged_path)
+        return staged_path
+
+    def release(self, source_path):
+        """Mark a staged file as no longer in use, making it available for eviction. The access time is not updated, as
+        each file is usually processed once, and a released copy should be evicted before the copies not used yet."""
+        staged_path = self._get_staged_path(source_path)
+        with self._lock:
+            pin_count = self._pinned.get(staged_path, 0) - 1
+            if pin_count > 0:
+                self._pinned[staged_path] = pin_count
+            else:
+                self._pinned.pop(staged_path, None)
+                fd = self._pin_fds.pop(staged_path, None)
+                if fd is not None:
+                    os.close(fd)
+
+    def close(self):
+        """Cancel the pending prefetches, wait for the current copy to finish and unlock the staged copies."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            for fd in self._pin_fds.values():
+                os.close(fd)
+            self._pin_fds.clear()
+            self._pinned.clear()
@@ -0,0 +1,87 @@
+#  Copyright 2024 The Board of Trustees of the University of Illinois. All Rights Reserved.
+#
+#  Licensed under the terms of Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  The License is included in the distribution as LICENSE file.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+# This program crops an NDPI file once per tile traversal order, and displays the wall time and the metrics of each run.
+# Run it from the src folder. Drop the page cache between runs (e.g., sync; echo 3 > /proc/sys/vm/drop_caches) for
+# cold cache numbers, otherwise the first run warms the cache for the following ones.
+
+# usage: benchmark_traversal.py [-h] --input-file INPUT_FILE --output-dir OUTPUT_DIR [--tile_size TILE_SIZE]
+#                               [--traversals TRAVERSALS [TRAVERSALS ...]] [--align-to-native]
+#
+# Example:
+# python utils/benchmark_traversal.py -i /data/NDPI/NDPI_1.ndpi -o /scratch/benchmark --traversals column row block
+
+import argparse
+import json
+import os
+import subprocess
+import time
+
+
+def run_traversal(input_file, output_dir, tile_size, traversal, align_to_native):
+    """
+    Crop an NDPI file with the given traversal order.
+
+    :param input_file: Path to the NDPI file.
+    :param output_dir: Path to the output directory of this run.
+    :param tile_size: Size of the tiles.
+    :param traversal: Tile traversal order.
+    :param align_to_native: Align the tile step to the native tile size.
+    :return: Wall time in seconds and the metrics recorded in metadata.json.
+    """
+    command = ["python", "ndpi_tile_cropper_cli.py", "-i", input_file, "-o", output_dir, "-s", str(tile_size),
+               "-t", traversal, "-g", "WARNING"]
+    if align_to_native:
+        command.append("-a")
+
+    start_time = time.time()
+    subprocess.run(command, check=True)
+    wall_seconds = time.time() - start_time
+
+    img_name = os.path.basename(input_file).split(' ')[0].rsplit('.', maxsplit=1)[0]
+    with open(os.path.join(output_dir, img_name, 'metadata.json'), 'r') as f:
+        metadata = json.load(f)
+    return wall_seconds, metadata.get('metrics', dict())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the tile traversal orders on an NDPI file')
+    parser.add_argument('--input-file', '-i', type=str, help='NDPI file path', required=True)
+    parser.add_argument('--output-dir', '-o', type=str, help='benchmark output folder path', required=True)
+    parser.add_argument('--tile_size', '-s', type=int, default=1024, help='size of the tiles')
+    parser.add_argument('--traversals', nargs='+', default=['column', 'row', 'block', 'hilbert'],
+                        choices=['row', 'column', 'block', 'hilbert'], help='traversal orders to benchmark')
+    parser.add_argument('--align-to-native', '-a', action='store_true',
+                        help='align the tile step to the native tile size')
+    args = parser.parse_args()
+
+    results = []
+    for traversal in args.traversals:
+        # Every run starts from an empty output folder, so that no tile is skipped
+        run_output_dir = os.path.join(args.output_dir, traversal)
+        if os.path.exists(run_output_dir):
+            raise FileExistsError(f'Output folder {run_output_dir} already exists')
+        wall_seconds, metrics = run_traversal(args.input_file, run_output_dir, args.tile_size, traversal,
+                                              args.align_to_native)
+        results.append((traversal, wall_seconds, metrics))
+
+    print('traversal,wall seconds,tile planes written,seconds per megapixel')
+    for traversal, wall_seconds, metrics in results:
+        print(f'{traversal},{wall_seconds:.1f},{metrics.get("tile_planes_written")},'
+              f'{metrics.get("seconds_per_megapixel")}')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,46 +13,133 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import io
 import json
 import os
+import re
 import sys
+from zipfile import BadZipFile, ZipFile
 
+import numpy as np
 
-# Visit all the output folders, and read the metadata.json file, print the total number of tiles, and percent complete along with the folder name
+
+# Visit all the output folders and zip files, and read the metadata.json file, print the total number of tiles, and percent complete along with the slide name
+# While a --zip run is in progress, or after it was killed, the zip file central directory is incomplete and the latest
+# metadata and tile index are in the output folder of the slide, so there is one row per slide.
+
+# Tile index shards written at the checkpoints of a run, and merged into tile_index.npz at exit
+TILE_INDEX_SHARD_PATTERN = re.compile(r'^tile_index_(\d+)\.npz$')
+
+
+def get_zip_status(zip_file_path):
+    if not os.path.exists(zip_file_path):
+        return None
+    # The zip file journal exists from the start of a --zip run until its zip file is closed
+    if os.path.exists(zip_file_path + '.journal'):
+        return 'in progress'
+    try:
+        with ZipFile(zip_file_path):
+            return 'complete'
+    except BadZipFile:
+        return 'in progress'
+
+
+def read_output_file(output_dir, file_name):
+    # Zip files may contain the image name directory. The last entry of a file name is the latest one.
+    if output_dir.endswith('.zip'):
+        if get_zip_status(output_dir) != 'complete':
+            return None
+        img_name = os.path.basename(output_dir)[:-len('.zip')]
+        with ZipFile(output_dir) as zip_file:
+            for name in [file_name, img_name + '/' + file_name]:
+                if name in zip_file.NameToInfo:
+                    return zip_file.read(name)
+        return None
+    output_file = os.path.join(output_dir, file_name)
+    if os.path.exists(output_file):
+        with open(output_file, 'rb') as f:
+            return f.read()
+    return None
+
+
+def get_output_path(output_folder_path, slide_name):
+    # The output folder has the latest metadata while a --zip run is in progress
+    output_dir_path = os.path.join(output_folder_path, slide_name)
+    zip_file_path = output_dir_path + '.zip'
+    if os.path.exists(os.path.join(output_dir_path, 'metadata.json')) or get_zip_status(zip_file_path) != 'complete':
+        return output_dir_path
+    return zip_file_path
 
 
 def get_tile_count(output_dir):
-    metadata_file = os.path.join(output_dir, 'metadata.json')
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as f:
-            metadata = json.load(f)
+    metadata_bytes = read_output_file(output_dir, 'metadata.json')
+    if metadata_bytes is not None:
+        metadata = json.loads(metadata_bytes)
         return metadata['total_tile_count']
     else:
         return None
 
 
 def get_percent_complete(output_dir):
-    metadata_file = os.path.join(output_dir, 'metadata.json')
-    if os.path.exists(metadata_file):
-        with open(metadata_file, 'r') as f:
-            metadata = json.load(f)
+    metadata_bytes = read_output_file(output_dir, 'metadata.json')
+    if metadata_bytes is not None:
+        metadata = json.loads(metadata_bytes)
         return metadata['percent_complete']
     else:
         return None
 
 
+def get_tile_index_summary(output_dir):
+    # The tile index shards of a running or killed run are not merged into tile_index.npz yet
+    tile_index_parts = []
+    tile_index_bytes = read_output_file(output_dir, 'tile_index.npz')
+    if tile_index_bytes is not None:
+        tile_index_parts.append(tile_index_bytes)
+    if os.path.isdir(output_dir):
+        shard_matches = [TILE_INDEX_SHARD_PATTERN.match(f) for f in os.listdir(output_dir)]
+        shard_numbers = sorted(int(shard_match.group(1)) for shard_match in shard_matches if shard_match is not None)
+        for shard_number in shard_numbers:
+            tile_index_parts.append(read_output_file(output_dir, f'tile_index_{shard_number}.npz'))
+    if len(tile_index_parts) == 0:
+        return None
+
+    tile_index = dict()
+    for tile_index_part_bytes in tile_index_parts:
+        with np.load(io.BytesIO(tile_index_part_bytes)) as tile_index_part:
+            for key in ['x', 'y', 'z', 'tissue_fraction', 'focus_score', 'empty']:
+                tile_index.setdefault(key, []).append(tile_index_part[key])
+    tile_index = {key: np.concatenate(values) for key, values in tile_index.items()}
+    # Keep the latest statistics of each tile z-plane
+    xyz = np.stack([tile_index['x'], tile_index['y'], tile_index['z']], axis=1)
+    _, last_reversed_indices = np.unique(xyz[::-1], axis=0, return_index=True)
+    keep_indices = len(xyz) - 1 - last_reversed_indices
+
+    summary = dict()
+    summary['tile_plane_count'] = len(keep_indices)
+    summary['empty_tile_plane_count'] = int(np.count_nonzero(tile_index['empty'][keep_indices]))
+    summary['mean_tissue_fraction'] = round(float(tile_index['tissue_fraction'][keep_indices].mean()), 4) if len(keep_indices) > 0 else None
+    summary['median_focus_score'] = round(float(np.median(tile_index['focus_score'][keep_indices])), 2) if len(keep_indices) > 0 else None
+    return summary
+
+
 def main():
     output_folder_path = sys.argv[1]
     print(f'Output folder path: {output_folder_path}')
-    output_dirs = [d for d in os.listdir(output_folder_path) if os.path.isdir(os.path.join(output_folder_path, d))]
-    print('tile dir,tile count, percent complete')
-    for output_dir in output_dirs:
-        output_dir_path = os.path.join(output_folder_path, output_dir)
-        tile_count = get_tile_count(output_dir_path)
-        percent_complete = get_percent_complete(output_dir_path)
-        print(f'{output_dir},{tile_count},{percent_complete}')
+    slide_names = sorted(set(d[:-len('.zip')] if d.endswith('.zip') else d for d in os.listdir(output_folder_path)
+                             if os.path.isdir(os.path.join(output_folder_path, d)) or d.endswith('.zip')))
+    print('tile dir,tile count, percent complete, indexed tile planes, empty tile planes, mean tissue fraction, median focus score, zip status')
+    for slide_name in slide_names:
+        output_path = get_output_path(output_folder_path, slide_name)
+        tile_count = get_tile_count(output_path)
+        percent_complete = get_percent_complete(output_path)
+        tile_index_summary = get_tile_index_summary(output_path)
+        zip_status = get_zip_status(os.path.join(output_folder_path, slide_name + '.zip'))
+        if tile_index_summary is None:
+            tile_index_summary = dict.fromkeys(['tile_plane_count', 'empty_tile_plane_count', 'mean_tissue_fraction', 'median_focus_score'])
+        print(f'{slide_name},{tile_count},{percent_complete},{tile_index_summary["tile_plane_count"]},'
+              f'{tile_index_summary["empty_tile_plane_count"]},{tile_index_summary["mean_tissue_fraction"]},'
+              f'{tile_index_summary["median_focus_score"]},{zip_status}')
 
 
 if __name__ == '__main__':
     main()
-